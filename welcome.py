@@ -5,10 +5,59 @@ import time
 import logging
 import re
 from pathlib import Path
-from typing import Any, Dict, List, Tuple, Optional, Set
+from typing import Any, Dict, Iterable, List, Tuple, Optional, Set, Union
 import tomllib
-import uuid
-from asyncio import Queue
+import os
+import random
+import itertools
+import inspect
+import functools
+import sys
+from asyncio import Queue, QueueFull
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from operator import attrgetter, itemgetter
+
+try:
+    import rtoml  # 可选：原生 TOML 解析，重载时更快
+    _toml_loads = rtoml.loads
+except ImportError:
+    _toml_loads = tomllib.loads
+
+try:
+    import orjson  # 可选：更快的 JSON 编解码（WebSocket 收发）
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj, pretty: bool = False) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else None)
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj, pretty: bool = False) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, indent=2 if pretty else None).encode("utf-8")
+
+try:
+    import ahocorasick  # 可选：pyahocorasick，触发词多时匹配更快
+except ImportError:
+    ahocorasick = None
+
+try:
+    import uvloop  # 可选：libuv 事件循环（不支持 Windows）
+except ImportError:
+    uvloop = None
+
+try:
+    # 可选：watchdog（Linux 上走 inotify），有它就不用每 2 秒扫一遍目录
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+# 排序用的 key（C 实现，比 lambda 快）
+_K0 = itemgetter(0)
+_BY_NAME = attrgetter("name")
+_BY_ORDER_KEY = attrgetter("order_key")
 
 # ==================== 路径 ====================
 BASE = Path(__file__).parent
@@ -32,7 +81,7 @@ def parse_md_with_frontmatter(p: Path) -> Tuple[Dict[str, Any], str]:
             meta_raw = text[3:end].strip()
             body = text[end+3:].lstrip("\r\n")
             try:
-                meta = tomllib.loads(meta_raw) if meta_raw else {}
+                meta = _toml_loads(meta_raw) if meta_raw else {}
             except Exception as e:
                 logging.warning(f"[FM] 解析 TOML 失败：{p}，错误：{e}")
                 meta = {}
@@ -40,94 +89,305 @@ def parse_md_with_frontmatter(p: Path) -> Tuple[Dict[str, Any], str]:
     return {}, text
 
 def read_toml(p: Path) -> dict:
-    with open(p, "rb") as f:
-        return tomllib.load(f)
+    return _toml_loads(read_text(p))
 
-# ---- 动作应答通道 ----
-PENDING_ACTIONS: Dict[str, asyncio.Future] = {}
-EVENT_QUEUE: "Queue[dict]" = Queue()
-
-def _new_echo(prefix="act"):
-    return f"{prefix}:{uuid.uuid4().hex}"
-
-async def send_action(ws, action: str, params: dict, timeout: float = 10.0) -> dict:
+# ==================== 触发词索引 ====================
+def build_keyword_index(trigger_lists: List[List[str]]) -> Any:
     """
-    通过 echo 等待 OneBot11 的动作应答（包含 message_id 等）。
-    注意：需要 ws_reader 持续收包并派发应答。
+    把每个条目的触发词列表编成索引：小写关键词 -> (原词长度, 原词, 条目下标)。
+    装了 pyahocorasick 时编成自动机（一次线性扫描），否则退回普通 dict。
+    同一关键词出现在多个条目时，保留靠前的条目。
+    关键词只在这里小写一次并 intern，匹配时不再逐词 .lower()。
     """
-    echo = _new_echo(action)
-    fut = asyncio.get_running_loop().create_future()
-    PENDING_ACTIONS[echo] = fut
-    payload = {"action": action, "params": params, "echo": echo}
-    await ws.send(json.dumps(payload, ensure_ascii=False))
-    try:
-        resp = await asyncio.wait_for(fut, timeout=timeout)
-    finally:
-        PENDING_ACTIONS.pop(echo, None)
-    return resp
+    table: Dict[str, Tuple[int, str, int]] = {}
+    for idx, triggers in enumerate(trigger_lists):
+        for kw in triggers:
+            low = sys.intern(kw.lower())
+            if low and low not in table:
+                table[low] = (len(kw), sys.intern(kw), idx)
+    if ahocorasick is None:
+        return table
+    ac = ahocorasick.Automaton()
+    for low, val in table.items():
+        ac.add_word(low, val)
+    if table:
+        ac.make_automaton()
+    return ac
+
+def longest_keyword(index: Any, text_lower: str) -> Optional[Tuple[int, str, int]]:
+    """
+    在已小写的文本里找最长命中的关键词，返回 (长度, 原词, 条目下标)。
+    等长时取靠前的条目（与逐条扫描的旧行为一致）。
+    """
+    if not index or not text_lower:
+        return None
+    if isinstance(index, dict):
+        hits = (v for low, v in index.items() if low in text_lower)
+    else:
+        hits = (v for _, v in index.iter(text_lower))
+    best = None
+    for v in hits:
+        if best is None or v[0] > best[0] or (v[0] == best[0] and v[2] < best[2]):
+            best = v
+    return best
 
-async def ws_reader(ws):
+# ---- 动作应答通道 ----
+# 不设上限：reader 同时负责投递动作应答，绝不能因为事件积压而停下收包。
+# 主循环取出后立刻分到各分片的有界队列（满了就丢，见 SHARD_QUEUE_MAX），这里本身不会积压
+EVENT_QUEUE: "Queue[Optional[dict]]" = Queue()
+
+# 收包预筛：心跳/生命周期等 meta_event 没有任何处理逻辑，不必解析 JSON。
+# 消息正文里的引号会被转义成 \"，所以用户发的文字不会误命中。
+_META_EVENT_RE = re.compile(r'"post_type"\s*:\s*"meta_event"')
+_META_EVENT_RE_B = re.compile(rb'"post_type"\s*:\s*"meta_event"')
+
+def is_ignorable_frame(msg) -> bool:
+    """不是动作应答也不是事件、或者是 meta_event 的帧，直接丢掉"""
+    if isinstance(msg, str):
+        if '"post_type"' not in msg:
+            return '"echo"' not in msg
+        return _META_EVENT_RE.search(msg) is not None
+    if b'"post_type"' not in msg:
+        return b'"echo"' not in msg
+    return _META_EVENT_RE_B.search(msg) is not None
+
+@functools.lru_cache(maxsize=None)
+def _envelope_head(action: str) -> bytes:
+    """动作帧的固定开头 {"action":"...","params":，每种动作只编码一次"""
+    return b'{"action":"%s","params":' % action.encode()
+
+# 同时在途的动作上限（须为 2 的幂）：echo 序号按位与落到固定槽位
+PENDING_SLOTS = 4096
+# 等待单个动作应答的超时（秒）
+ACTION_TIMEOUT = 10.0
+
+class WSChannel:
     """
-    专门的收包任务：
-    - 若是动作应答（含 echo/status），投递到 PENDING_ACTIONS
-    - 若是事件（含 post_type），投递到 EVENT_QUEUE
+    一条 WebSocket 连接上的动作通道：自己维护 echo 计数和待应答槽位。
+    echo 只需要在单条连接内唯一，用自增计数即可，不必每次生成 UUID；
+    序号 & (PENDING_SLOTS-1) 就是槽位下标，应答回来时直接按下标取，不走字典。
+    发出的帧先进 outbox，由同一个 flush 任务按顺序写出：同一轮事件循环里
+    连着发的多个动作一次写完，调用方不用各自等 send。
+    （OneBot11 一帧只认一个动作，所以帧本身不合并。）
+    事件处理函数里的 ws 参数拿到的就是它。
     """
-    async for msg in ws:
+    def __init__(self, ws):
+        self.ws = ws
+        self.pending: List[Optional[Tuple[str, asyncio.Future]]] = [None] * PENDING_SLOTS
+        self._echo_counter = itertools.count()
+        self._outbox: List[Tuple[bytes, asyncio.Future]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        # websockets 新版 send 支持 text=True：UTF-8 bytes 直接作为文本帧发出，不用再解码/编码一遍。
+        # 旧版只能传 str（直接传 bytes 会变成二进制帧，OneBot 实现不一定认）
         try:
-            data = json.loads(msg)
-        except Exception:
-            continue
-        # 动作应答
-        if isinstance(data, dict) and data.get("echo") and data.get("status"):
-            fut = PENDING_ACTIONS.get(data["echo"])
-            if fut and not fut.done():
-                fut.set_result(data)
-            continue
-        # 事件
-        await EVENT_QUEUE.put(data)
-        
+            self._send_text_bytes = "text" in inspect.signature(ws.send).parameters
+        except (TypeError, ValueError):
+            self._send_text_bytes = False
+        # 同理，新版 recv 支持 decode=False：文本帧原样给出 UTF-8 bytes，省掉解码和校验，
+        # 反正 JSON 解析器直接吃 bytes
+        try:
+            self._recv_bytes = "decode" in inspect.signature(ws.recv).parameters
+        except (TypeError, ValueError):
+            self._recv_bytes = False
+
+    def post_action(self, action: str, params: Union[dict, bytes]) -> asyncio.Future:
+        """
+        把动作放进 outbox 等待写出，不等应答；返回应答 Future（由 reader 填充）。
+        params 也可以是已经编码好的 JSON 对象 bytes（见 send_log），这时只拼外层，不再编码。
+        写出失败时 Future 带上异常；Future 结束（含超时被取消）时自动腾出槽位。
+        """
+        seq = next(self._echo_counter)
+        slot = seq & (PENDING_SLOTS - 1)
+        echo = f"{action}:{seq}"
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        old = self.pending[slot]
+        if old is not None and not old[1].done():
+            # 槽位绕了一圈还没等到应答，说明早就超时了，直接让位
+            logging.warning(f"在途动作超过 {PENDING_SLOTS} 个，放弃等待 {old[0]}")
+            old[1].cancel()
+        self.pending[slot] = (echo, fut)
+        fut.add_done_callback(lambda _: self._release(slot, fut))
+        if isinstance(params, bytes):
+            # action/echo 都是 ASCII 标识符，直接拼进去不需要转义
+            data = b"".join((_envelope_head(action), params, b',"echo":"', echo.encode(), b'"}'))
+        else:
+            data = _json_dumps({"action": action, "params": params, "echo": echo})
+        self._outbox.append((data, fut))
+        if self._flush_task is None:
+            self._flush_task = loop.create_task(self._flush())
+        return fut
+
+    async def _flush(self):
+        """把 outbox 里攒下的帧按顺序写出，写完（含期间新进来的）再退出"""
+        try:
+            while self._outbox:
+                batch, self._outbox = self._outbox, []
+                for i, (data, fut) in enumerate(batch):
+                    if fut.done():
+                        continue  # 已超时/取消，不必再发
+                    try:
+                        if self._send_text_bytes:
+                            await self.ws.send(data, text=True)
+                        else:
+                            await self.ws.send(data.decode("utf-8"))
+                    except Exception as e:
+                        for _, f in batch[i:] + self._outbox:
+                            if not f.done():
+                                f.set_exception(e)
+                        self._outbox = []
+                        return
+        finally:
+            self._flush_task = None
+
+    async def send_action(self, action: str, params: Union[dict, bytes], timeout: float = ACTION_TIMEOUT) -> dict:
+        """
+        通过 echo 等待 OneBot11 的动作应答（包含 message_id 等）。
+        注意：需要 reader 持续收包并派发应答。
+        """
+        fut = self.post_action(action, params)
+        return await asyncio.wait_for(fut, timeout=timeout)
+
+    def _release(self, slot: int, fut: asyncio.Future):
+        entry = self.pending[slot]
+        if entry is not None and entry[1] is fut:
+            self.pending[slot] = None
+
+    def resolve(self, echo, data: dict):
+        """把动作应答交给对应的 Future；echo 不是本连接发出的就忽略"""
+        if not isinstance(echo, str):
+            return
+        _, _, seq = echo.rpartition(":")
+        if not seq.isdigit():
+            return
+        entry = self.pending[int(seq) & (PENDING_SLOTS - 1)]
+        if entry is not None and entry[0] == echo and not entry[1].done():
+            entry[1].set_result(data)
+
+    async def reader(self):
+        """
+        专门的收包任务：
+        - 若是动作应答（含 echo/status），投递到 pending
+        - 若是事件（含 post_type），投递到 EVENT_QUEUE
+        连接正常关闭时返回，异常断开时抛出（与 async for 遍历连接一致）。
+        退出时立刻取消还在等应答的动作，不用等主循环排到断线通知。
+        """
+        recv = functools.partial(self.ws.recv, decode=False) if self._recv_bytes else self.ws.recv
+        try:
+            while True:
+                try:
+                    msg = await recv()
+                except websockets.exceptions.ConnectionClosedOK:
+                    return
+                if is_ignorable_frame(msg):
+                    continue
+                try:
+                    data = _json_loads(msg)
+                except Exception:
+                    continue
+                if not isinstance(data, dict):
+                    continue
+                # 动作应答
+                if data.get("echo") and data.get("status"):
+                    self.resolve(data["echo"], data)
+                    continue
+                # 事件（队列不设上限，不会等待）
+                EVENT_QUEUE.put_nowait(data)
+        finally:
+            self.close()
+
+    def close(self):
+        """连接断开后，取消还没写出/还在等应答的动作，不必干等到超时"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        self._outbox = []
+        for entry in self.pending:
+            if entry is not None:
+                entry[1].cancel()
+
 # ==================== OneBot11 发送（群聊）====================
+_group_id_int: Dict[Any, int] = {}
+
+def _gid(group_id) -> int:
+    """群号转 int 并缓存（群的数量有限，不会无限增长）"""
+    gid = _group_id_int.get(group_id)
+    if gid is None:
+        gid = _group_id_int[group_id] = int(group_id)
+    return gid
+
+def _sid(x) -> str:
+    """
+    事件里的群号/QQ 转 str 并驻留：同一个号反复出现时拿到同一个对象，
+    冷却表、群状态表等按它查时走身份比较的快路径（群和活跃用户数量有限）
+    """
+    return sys.intern(str(x))
+
+# 纯文本消息的 params 骨架：只需填群号/QQ 和编码好的 message，不用每次构造 dict 再整体编码
+_GROUP_MSG_PARAMS = b'{"group_id":%d,"message":%s}'
+_PRIVATE_MSG_PARAMS = b'{"user_id":%d,"message":%s}'
+
+def post_group_msg(ws, group_id, message) -> asyncio.Future:
+    """只把 send_group_msg 发出去，不等应答；返回应答 Future（见 WSChannel.post_action）"""
+    params = _GROUP_MSG_PARAMS % (_gid(group_id), _json_dumps(message))
+    return ws.post_action("send_group_msg", params)
+
 async def send_group_msg(ws, group_id, message):
-    resp = await send_action(ws, "send_group_msg", {
-        "group_id": int(group_id),
-        "message": message
-    })
+    fut = post_group_msg(ws, group_id, message)
+    resp = await asyncio.wait_for(fut, timeout=ACTION_TIMEOUT)
     data = resp.get("data") or {}
     return data.get("message_id") or data.get("id")
 
 async def send_group_msg_segments(ws, group_id, segments: list):
-    resp = await send_action(ws, "send_group_msg", {
-        "group_id": int(group_id),
+    resp = await ws.send_action("send_group_msg", {
+        "group_id": _gid(group_id),
         "message": segments
     })
     data = resp.get("data") or {}
     return data.get("message_id") or data.get("id")
 
+@functools.lru_cache(maxsize=64)
+def _build_forward_nodes(messages: Tuple[str, ...], sender_id, sender_name: str) -> Tuple[dict, ...]:
+    """
+    合并转发节点；欢迎包/组合触发的内容是固定的，同样的输入直接复用上次构造的结果。
+    返回值会被多次共享，只用于序列化，不要修改。
+    """
+    uin = str(sender_id)
+    return tuple(
+        {"type": "node", "data": {"name": sender_name, "uin": uin, "content": msg}}
+        for msg in messages
+    )
+
 async def send_forward_message(ws, group_id, messages, sender_id, sender_name="洛拉娜·奥蕾莉娅"):
-    nodes = []
-    for msg in messages:
-        nodes.append({
-            "type": "node",
-            "data": {"name": sender_name, "uin": str(sender_id), "content": msg}
-        })
-    resp = await send_action(ws, "send_group_forward_msg", {
-        "group_id": int(group_id),
+    nodes = _build_forward_nodes(tuple(messages), sender_id, sender_name)
+    resp = await ws.send_action("send_group_forward_msg", {
+        "group_id": _gid(group_id),
         "messages": nodes
     })
     data = resp.get("data") or {}
     return data.get("message_id") or data.get("id")
 
+# 日志群的固定文案：消息预先编码成 JSON 字符串 bytes，发送时只把群号/QQ/时间戳填进去
+LOG_MEMBER_JOIN = _json_dumps("【日志】用户 %s 加入群 %s，时间戳：%s")
+LOG_TIMER_RESET = _json_dumps("【日志】定时器重置：%s")
+LOG_WELCOME_EMPTY = _json_dumps("【日志】触发失败：新人列表为空，群号：%s")
+LOG_WELCOME_START = _json_dumps("【日志】开始发送欢迎消息：%s")
+
+async def send_log(ws, template: bytes, *args):
+    """按模板往 log_group 发一条日志，整条动作不再走 JSON 编码"""
+    # 参数本身单独转义（通常是纯数字，几乎零开销），拼进去的结果仍是合法 JSON
+    message = template % tuple(_json_dumps(str(a))[1:-1] for a in args)
+    params = _GROUP_MSG_PARAMS % (_gid(STORE.settings["log_group"]), message)
+    await ws.send_action("send_group_msg", params)
+
 # ==================== OneBot11 发送（私聊）====================
 async def send_private_msg(ws, user_id, message):
-    resp = await send_action(ws, "send_private_msg", {
-        "user_id": int(user_id),
-        "message": message
-    })
+    params = _PRIVATE_MSG_PARAMS % (int(user_id), _json_dumps(message))
+    resp = await ws.send_action("send_private_msg", params)
     data = resp.get("data") or {}
     return data.get("message_id") or data.get("id")
 
 async def send_private_msg_segments(ws, user_id, segments: list):
-    resp = await send_action(ws, "send_private_msg", {
+    resp = await ws.send_action("send_private_msg", {
         "user_id": int(user_id),
         "message": segments
     })
@@ -135,14 +395,9 @@ async def send_private_msg_segments(ws, user_id, segments: list):
     return data.get("message_id") or data.get("id")
 
 async def send_private_forward_message(ws, user_id, messages, sender_id, sender_name="洛拉娜·奥蕾莉娅"):
-    nodes = []
-    for msg in messages:
-        nodes.append({
-            "type": "node",
-            "data": {"name": sender_name, "uin": str(sender_id), "content": msg}
-        })
+    nodes = _build_forward_nodes(tuple(messages), sender_id, sender_name)
     # OneBot11: send_private_forward_msg
-    resp = await send_action(ws, "send_private_forward_msg", {
+    resp = await ws.send_action("send_private_forward_msg", {
         "user_id": int(user_id),
         "messages": nodes
     })
@@ -150,24 +405,62 @@ async def send_private_forward_message(ws, user_id, messages, sender_id, sender_
     return data.get("message_id") or data.get("id")
 
 # ==================== 热重载内容存储 ====================
+class Pack:
+    """
+    一个目录 = 一组合并转发片段（欢迎包、组合触发共用）。
+    parts 构造时按文件名排好序，texts/files 是发送和日志直接用的结果；
+    都存成 tuple，发送时直接作为转发节点缓存的 key，不再复制。
+    """
+    __slots__ = ("order_key", "parts", "dir_path", "triggers", "texts", "files")
+
+    def __init__(self, order_key: str, parts: List[Tuple[str, str, Path]], dir_path: Path,
+                 triggers: Optional[List[str]] = None):
+        self.order_key = order_key
+        self.parts: Tuple[Tuple[str, str, Path], ...] = tuple(sorted(parts, key=_K0))
+        self.dir_path = dir_path
+        self.triggers: List[str] = triggers or []
+        self.texts: Tuple[str, ...] = tuple(b for _, b, _ in self.parts if b)
+        self.files: Tuple[str, ...] = tuple(p.name for _, _, p in self.parts)
+
 class Store:
     def __init__(self):
         self.settings: Dict[str, Any] = {}
         # welcome：
         # - plain_msgs: List[(order_key, text, path)]
-        # - packs: List[(order_key, List[(order_key, text, path)] , dirpath)]
+        # - packs: List[Pack]
         self.welcome_plain: List[Tuple[str, str, Path]] = []
-        self.welcome_packs: List[Tuple[str, List[Tuple[str, str, Path]], Path]] = []
+        self.welcome_packs: List[Pack] = []
 
         # triggers：
         # - singles: List[(triggers[], order_key, text, path)]
-        # - groups: List[(triggers[], order_key, List[(order_key, text, path)], dirpath)]
+        # - groups: List[Pack]（带 triggers）
         self.trig_singles: List[Tuple[List[str], str, str, Path]] = []
-        self.trig_groups:  List[Tuple[List[str], str, List[Tuple[str, str, Path]], Path]] = []
+        self.trig_groups:  List[Pack] = []
+        # 触发词索引（load_all 时重建），见 build_keyword_index
+        self.ac_single: Any = {}
+        self.ac_group: Any = {}
+        # 称呼正则（load_all 时按 settings.names 预编译），见 contains_any_name
+        self.names_re: Optional[re.Pattern] = None
+        # “名字回应开/关”正则、配置白名单触发群和两个触发许可开关，同样在 load_all 时算好
+        self.switch_re: Optional[re.Pattern] = None
+        self.trigger_groups: frozenset = frozenset()
+        self.allow_nonlisted = False
+        self.enable_private = True
 
         self._mtimes: Dict[Path, float] = {}
+        # load_all 扫描时顺手记下的 settings / 目录 / md 路径，轮询时只 stat 这些，不再 glob。
+        # 目录也在内：增删文件会改目录的 mtime，新文件照样能发现
+        self._tracked_paths: List[Path] = []
         self.self_id: Optional[str] = None  # 当前机器人ID（从事件里拿）
 
+        # watchdog 观察线程只负责标脏（线程安全地置位 asyncio.Event），真正的重载在 reloader_loop 里做
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._dirty_event: Optional[asyncio.Event] = None
+        self._observer = None
+
+        # md 解析缓存：path -> (mtime, size, meta, body)；没变的文件重载时不再读盘和解析 TOML
+        self._file_cache: Dict[Path, Tuple[float, int, Dict[str, Any], str]] = {}
+
     def _mtime(self, p: Path) -> float:
         try:
             return p.stat().st_mtime
@@ -178,23 +471,55 @@ class Store:
         # 用文件/目录名作为顺序 key（字符串排序即可：000_* < 001_*）
         return p.name
 
-    def _list_md(self, d: Path) -> List[Path]:
-        return sorted([p for p in d.glob("*.md") if p.is_file()], key=lambda x: x.name)
+    def _stat(self, p: Path) -> Optional[os.stat_result]:
+        try:
+            return p.stat()
+        except FileNotFoundError:
+            return None
+
+    def _load_md(self, p: Path, fresh: dict, scanned: dict) -> Tuple[Dict[str, Any], str]:
+        """带缓存的 parse_md_with_frontmatter；命中/解析的结果都记进 fresh（本轮用到的缓存）"""
+        st = scanned.get(p) or p.stat()
+        cached = self._file_cache.get(p)
+        if cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+            meta, body = cached[2], cached[3]
+        else:
+            meta, body = parse_md_with_frontmatter(p)
+        fresh[p] = (st.st_mtime, st.st_size, meta, body)
+        return meta, body
+
+    def _list_md(self, d: Path, scanned: Dict[Path, Optional[os.stat_result]]) -> List[Path]:
+        """
+        列出目录下的 md（按文件名排序），目录和文件的 stat 顺手记进 scanned：
+        os.scandir 一次拿到类型，每个文件只 stat 一次，解析缓存和 mtime 记录都复用它。
+        """
+        scanned[d] = self._stat(d)
+        files: List[Path] = []
+        try:
+            with os.scandir(d) as it:
+                for e in it:
+                    if e.name.endswith(".md") and e.is_file():
+                        p = Path(e.path)
+                        scanned[p] = e.stat()
+                        files.append(p)
+        except FileNotFoundError:
+            pass
+        files.sort(key=_BY_NAME)
+        return files
 
-    def _changed(self, paths: List[Path]) -> bool:
-        dirty = False
+    def _changed(self, paths: Iterable[Path]) -> bool:
+        """发现第一处 mtime 变化就返回；新的 mtime 由随后的 load_all 统一记录"""
+        mtimes = self._mtimes
         for p in paths:
-            m = self._mtime(p)
-            if self._mtimes.get(p) != m:
-                self._mtimes[p] = m
-                dirty = True
-        return dirty
+            if mtimes.get(p) != self._mtime(p):
+                return True
+        return False
 
     def _log_summary(self):
         wp_plain_cnt = len(self.welcome_plain)
-        wp_pack_cnt  = sum(len(parts) for _, parts, _ in self.welcome_packs)
+        wp_pack_cnt  = sum(len(pk.parts) for pk in self.welcome_packs)
         trg_single_cnt = len(self.trig_singles)
-        trg_group_pack_cnt = sum(len(parts) for _, _, parts, _ in self.trig_groups)
+        trg_group_pack_cnt = sum(len(pk.parts) for pk in self.trig_groups)
         trg_group_cnt = len(self.trig_groups)
 
         logging.info(
@@ -203,98 +528,185 @@ class Store:
         )
 
     def load_all(self):
+        """
+        重新读取 settings 与欢迎/触发目录。列表和触发词索引先在局部变量里建好，
+        全部成功后再一起换到 self 上：中途读盘出错（如 md 不是 UTF-8）时保留上一版配置，
+        不会出现索引还指着旧列表下标、列表却已被清空的情况。
+        """
         # settings
         st = CONF / "settings.toml"
-        self.settings = read_toml(st)
+        settings = read_toml(st)
         logging.info(f"⚙️ 读取 settings.toml 成功：{st}")
+        names = [n for n in (settings.get("names", []) or []) if n]
+
+        fresh: Dict[Path, Tuple[float, int, Dict[str, Any], str]] = {}
+        # 目录不存在也记着（mtime=-1），之后被创建出来能发现
+        scanned: Dict[Path, Optional[os.stat_result]] = {p: self._stat(p) for p in (st, WELCOME_DIR, TRIG_DIR)}
 
         # welcome
-        self.welcome_plain = []
-        self.welcome_packs = []
+        welcome_plain: List[Tuple[str, str, Path]] = []
+        welcome_packs: List[Pack] = []
         if WELCOME_DIR.exists():
             logging.info(f"📁 扫描欢迎目录：{WELCOME_DIR}")
             # 根级 md → 普通消息
-            for f in self._list_md(WELCOME_DIR):
-                meta, body = parse_md_with_frontmatter(f)
-                self.welcome_plain.append((self._index_key(f), body.strip(), f))
-                logging.debug(f"  - 欢迎根级：{f}")
+            for f in self._list_md(WELCOME_DIR, scanned):
+                meta, body = self._load_md(f, fresh, scanned)
+                welcome_plain.append((self._index_key(f), body.strip(), f))
+                logging.debug("  - 欢迎根级：%s", f)
 
             # 子目录 → 合并转发
-            for sub in sorted([p for p in WELCOME_DIR.iterdir() if p.is_dir()], key=lambda x: x.name):
+            for sub in sorted([p for p in WELCOME_DIR.iterdir() if p.is_dir()], key=_BY_NAME):
                 parts: List[Tuple[str, str, Path]] = []
-                for f in self._list_md(sub):
+                for f in self._list_md(sub, scanned):
                     if f.name.startswith("_"):
                         continue
-                    _, body = parse_md_with_frontmatter(f)
+                    _, body = self._load_md(f, fresh, scanned)
                     parts.append((self._index_key(f), body.strip(), f))
-                    logging.debug(f"  - 欢迎包片段：{f}")
+                    logging.debug("  - 欢迎包片段：%s", f)
                 if parts:
-                    self.welcome_packs.append((self._index_key(sub), parts, sub))
-                    logging.debug(f"  * 欢迎包目录：{sub}（片段数 {len(parts)}）")
+                    welcome_packs.append(Pack(self._index_key(sub), parts, sub))
+                    logging.debug("  * 欢迎包目录：%s（片段数 %d）", sub, len(parts))
+
+        welcome_plain.sort(key=_K0)
+        welcome_packs.sort(key=_BY_ORDER_KEY)
 
         # triggers
-        self.trig_singles = []
-        self.trig_groups = []
+        trig_singles: List[Tuple[List[str], str, str, Path]] = []
+        trig_groups: List[Pack] = []
         if TRIG_DIR.exists():
             logging.info(f"📁 扫描触发目录：{TRIG_DIR}")
             # 根级 .md → 单条触发
-            for f in self._list_md(TRIG_DIR):
-                meta, body = parse_md_with_frontmatter(f)
+            for f in self._list_md(TRIG_DIR, scanned):
+                meta, body = self._load_md(f, fresh, scanned)
                 if meta.get("triggers"):
                     tlist = [t for t in meta["triggers"] if isinstance(t, str) and t.strip()]
                     if tlist:
-                        self.trig_singles.append((tlist, self._index_key(f), body.strip(), f))
-                        logging.debug(f"  - 单条触发：{f} | 触发词={tlist}")
+                        trig_singles.append((tlist, self._index_key(f), body.strip(), f))
+                        logging.debug("  - 单条触发：%s | 触发词=%s", f, tlist)
 
             # 子目录 → 触发即合并转发
-            for sub in sorted([p for p in TRIG_DIR.iterdir() if p.is_dir()], key=lambda x: x.name):
+            for sub in sorted([p for p in TRIG_DIR.iterdir() if p.is_dir()], key=_BY_NAME):
                 triggers: List[str] = []
-                for f in self._list_md(sub):
+                files = self._list_md(sub, scanned)
+                for f in files:
                     if not f.name.startswith("_"):
                         continue
-                    meta, _ = parse_md_with_frontmatter(f)
+                    meta, _ = self._load_md(f, fresh, scanned)
                     if meta.get("triggers"):
                         triggers.extend(list(meta["triggers"]))
                 triggers = [t for t in triggers if isinstance(t, str) and t.strip()]
                 parts: List[Tuple[str, str, Path]] = []
-                for f in self._list_md(sub):
+                for f in files:
                     if f.name.startswith("_"):
                         continue
-                    _, body = parse_md_with_frontmatter(f)
+                    _, body = self._load_md(f, fresh, scanned)
                     parts.append((self._index_key(f), body.strip(), f))
                 if triggers and parts:
-                    self.trig_groups.append((triggers, self._index_key(sub), parts, sub))
-                    logging.debug(f"  * 组合触发目录：{sub} | 触发词={triggers} | 片段数={len(parts)}")
+                    trig_groups.append(Pack(self._index_key(sub), parts, sub, triggers))
+                    logging.debug("  * 组合触发目录：%s | 触发词=%s | 片段数=%d", sub, triggers, len(parts))
+
+        ac_single = build_keyword_index([tlist for tlist, _, _, _ in trig_singles])
+        ac_group = build_keyword_index([pk.triggers for pk in trig_groups])
+        names_re = re.compile("|".join(re.escape(n) for n in names), re.IGNORECASE) if names else None
+        switch_re = _build_switch_regex(names)
+
+        # 到这里都成功了，一次性换上新配置
+        self.settings = settings
+        self.names_re = names_re
+        self.switch_re = switch_re
+        self.trigger_groups = frozenset(str(x) for x in settings.get("trigger_groups", []))
+        self.allow_nonlisted = bool(settings.get("trigger_allow_nonlisted_groups", False))
+        self.enable_private = bool(settings.get("trigger_enable_private", True))
+        self.welcome_plain = welcome_plain
+        self.welcome_packs = welcome_packs
+        self.trig_singles = trig_singles
+        self.trig_groups = trig_groups
+        self.ac_single = ac_single
+        self.ac_group = ac_group
+
+        # 只保留本轮还在的文件，删掉的自然被丢弃
+        self._file_cache = fresh
 
         # 记录 mtime
-        paths = [st]
-        if WELCOME_DIR.exists():
-            paths += list(WELCOME_DIR.glob("**/*.md"))
-        if TRIG_DIR.exists():
-            paths += list(TRIG_DIR.glob("**/*.md"))
-        for p in paths:
-            self._mtimes[p] = self._mtime(p)
+        self._tracked_paths = list(scanned)
+        self._mtimes = {p: s.st_mtime if s else -1.0 for p, s in scanned.items()}
 
         self._log_summary()
 
     def maybe_reload(self) -> bool:
-        paths = [CONF / "settings.toml"]
-        if WELCOME_DIR.exists(): paths += list(WELCOME_DIR.glob("**/*.md"))
-        if TRIG_DIR.exists():    paths += list(TRIG_DIR.glob("**/*.md"))
-        if self._changed(paths):
-            logging.info("🔁 检测到配置文件变更，开始热重载…")
-            self.load_all()
-            logging.info("♻️ 热重载完成")
-            return True
-        return False
+        if not self._changed(self._tracked_paths):
+            return False
+        try:
+            self.reload()
+        except Exception:
+            # 加载失败也记下当前 mtime：等文件再次改动再重试，不必每轮轮询都报一遍错
+            self._mtimes = {p: self._mtime(p) for p in self._tracked_paths}
+            raise
+        return True
+
+    def reload(self):
+        logging.info("🔁 检测到配置文件变更，开始热重载…")
+        self.load_all()
+        logging.info("♻️ 热重载完成")
+
+    # ---- watchdog 标脏 ----
+    def mark_dirty(self):
+        """在观察线程里调用：切回事件循环线程去置位"""
+        try:
+            self._loop.call_soon_threadsafe(self._dirty_event.set)
+        except RuntimeError:
+            pass  # 事件循环已关闭（退出中）
+
+    async def wait_dirty(self):
+        """等到有配置变更；稍等片刻把编辑器保存时连续触发的多个事件合并成一次"""
+        await self._dirty_event.wait()
+        await asyncio.sleep(0.2)
+        self._dirty_event.clear()
+
+    def start_watch(self) -> bool:
+        """在事件循环里启动 watchdog 观察 config 目录；没装 watchdog 时返回 False，由调用方退回轮询"""
+        if Observer is None or not CONF.exists():
+            return False
+        self._loop = asyncio.get_running_loop()
+        self._dirty_event = asyncio.Event()
+        obs = Observer()
+        obs.schedule(ConfEventHandler(self), str(CONF), recursive=True)
+        obs.daemon = True
+        obs.start()
+        self._observer = obs
+        return True
+
+class ConfEventHandler(FileSystemEventHandler):
+    """
+    watchdog 回调（跑在观察线程里）：md / settings.toml 有增删改、或目录被移走删掉时标脏。
+    只看 created/modified/deleted/moved，load_all 自己读文件产生的 opened/closed 不算。
+    """
+    WATCH_TYPES = {"created", "modified", "deleted", "moved"}
+
+    def __init__(self, store: "Store"):
+        self.store = store
+
+    def on_any_event(self, event):
+        if event.event_type not in self.WATCH_TYPES:
+            return
+        if event.is_directory:
+            if event.event_type in {"deleted", "moved"}:
+                self.store.mark_dirty()
+            return
+        for path in (event.src_path, getattr(event, "dest_path", "")):
+            name = Path(str(path)).name if path else ""
+            if name.endswith(".md") or name == "settings.toml":
+                self.store.mark_dirty()
+                return
 
 STORE = Store()
 
 # ==================== 触发状态持久化（JSON） ====================
 STATE_PATH = CONF / "trigger_state.json"
-TRIG_STATE: Dict[str, List[str]] = {
-    "dm_blocked": [],     # 私聊被关闭的 QQ 列表（字符串）
-    "group_enabled": []   # 非白名单中，被开启触发的群号列表（字符串）
+# 内存里用 set（查询 O(1)），写 JSON 时再转成排好序的列表
+TRIG_STATE: Dict[str, Set[str]] = {
+    "dm_blocked": set(),     # 私聊被关闭的 QQ（字符串）
+    "group_enabled": set()   # 非白名单中，被开启触发的群号（字符串）
 }
 
 def _state_load():
@@ -303,77 +715,175 @@ def _state_load():
         if STATE_PATH.exists():
             TRIG_STATE = json.loads(STATE_PATH.read_text(encoding="utf-8"))
             # 容错：字段缺失则补齐
-            TRIG_STATE.setdefault("dm_blocked", [])
-            TRIG_STATE.setdefault("group_enabled", [])
+            TRIG_STATE["dm_blocked"] = set(TRIG_STATE.get("dm_blocked", []))
+            TRIG_STATE["group_enabled"] = set(TRIG_STATE.get("group_enabled", []))
         else:
             _state_save()
     except Exception as e:
         logging.warning(f"读取触发状态 JSON 异常：{e}")
         _state_save()
 
-def _state_save():
+# 由 state_writer_loop 创建；写入任务启动前（如启动时补文件）直接同步写
+_state_dirty: Optional[asyncio.Event] = None
+
+def _state_dump() -> bytes:
+    return _json_dumps({k: sorted(v) if isinstance(v, set) else v for k, v in TRIG_STATE.items()}, pretty=True)
+
+def _state_write(data: bytes):
     tmp = STATE_PATH.with_suffix(".json.tmp")
-    tmp.write_text(json.dumps(TRIG_STATE, ensure_ascii=False, indent=2), encoding="utf-8")
+    tmp.write_bytes(data)
     tmp.replace(STATE_PATH)
 
+def _state_save():
+    """标记触发状态待保存；真正写盘由 state_writer_loop 合并后放到线程池里做"""
+    if _state_dirty is None:
+        _state_write(_state_dump())
+    else:
+        _state_dirty.set()
+
+async def state_writer_loop():
+    """等待状态变脏，防抖 200ms 把连续的开关合并成一次写盘；退出前补写未保存的改动"""
+    global _state_dirty
+    _state_dirty = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            await _state_dirty.wait()
+            await asyncio.sleep(0.2)
+            _state_dirty.clear()
+            # 在事件循环里序列化出快照，写线程只碰 bytes，不会和后续修改并发
+            data = _state_dump()
+            try:
+                await loop.run_in_executor(None, _state_write, data)
+            except OSError as e:
+                logging.warning(f"保存触发状态 JSON 异常：{e}")
+    finally:
+        if _state_dirty.is_set():
+            _state_write(_state_dump())
+        _state_dirty = None
+
 # ==================== 迎新流程 ====================
-新人记录: Dict[str, List[str]] = {}
-定时器任务: Dict[str, asyncio.Task] = {}
-触发冷却记录: Dict[Tuple[str, str], float] = {}
+def log_exceptions(func):
+    """
+    事件处理函数（以及后台发送欢迎的任务）出错时只记一条警告：
+    不影响主循环继续收事件，也不会变成没人取回的 Task 异常
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            logging.warning(f"事件处理异常：{e}")
+    return wrapper
+
+class GroupState:
+    """一个群的迎新状态：待欢迎的新人和迎新定时器放在一起，一次查表拿到"""
+    __slots__ = ("newcomers", "timer")
+
+    def __init__(self):
+        # 用户 -> None：dict 保持加入顺序，查重 O(1)
+        self.newcomers: Dict[str, None] = {}
+        # 等待期间是 call_later 的 TimerHandle，到点后换成发送欢迎的 Task；两者都能 cancel()
+        self.timer: Optional[Union[asyncio.TimerHandle, asyncio.Task]] = None
+
+# 群 -> GroupState；欢迎发完（或从未有新人）的群不在表里
+GROUP_STATE: Dict[str, GroupState] = {}
+
+def group_state(group_id: str) -> GroupState:
+    gs = GROUP_STATE.get(group_id)
+    if gs is None:
+        gs = GROUP_STATE[group_id] = GroupState()
+    return gs
+
+def cancel_all_timers():
+    """退出时统一取消所有群的迎新定时器（等待中的 TimerHandle 或发送中的 Task）"""
+    for gs in GROUP_STATE.values():
+        if gs.timer is not None:
+            gs.timer.cancel()
+            gs.timer = None
+
+# (群, 用户) -> 上次触发的 time.monotonic()；按触发先后排列，最旧的在最前
+TRIG_COOLDOWN: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+COOLDOWN_MAX_ENTRIES = 10000
+
+def record_cooldown(key: Tuple[str, str], now: float, cd: float):
+    """记下本次触发时间，顺带淘汰已过期（超过 cd*8）以及超出上限的最旧记录"""
+    TRIG_COOLDOWN[key] = now
+    TRIG_COOLDOWN.move_to_end(key)
+    expire_before = now - cd * 8
+    while TRIG_COOLDOWN:
+        oldest = next(iter(TRIG_COOLDOWN.values()))
+        if oldest < expire_before or len(TRIG_COOLDOWN) > COOLDOWN_MAX_ENTRIES:
+            TRIG_COOLDOWN.popitem(last=False)
+        else:
+            break
 
 async def handle_new_member(ws, group_id, user_id):
-    now_ms = int(time.time() * 1000)
+    now_ms = time.time_ns() // 1_000_000
     logging.info(f"👋 新人加入 | 群 {group_id} | 用户 {user_id} | ts={now_ms}")
-    await send_group_msg(ws, STORE.settings["log_group"], f"【日志】用户 {user_id} 加入群 {group_id}，时间戳：{now_ms}")
+    await send_log(ws, LOG_MEMBER_JOIN, user_id, group_id, now_ms)
 
-    新人 = 新人记录.setdefault(group_id, [])
-    if user_id not in 新人:
-        新人.append(user_id)
-    logging.info(f"👥 当前待欢迎列表[{group_id}]：{新人}")
+    gs = group_state(group_id)
+    gs.newcomers[user_id] = None
+    logging.info(f"👥 当前待欢迎列表[{group_id}]：{list(gs.newcomers)}")
 
-    if group_id in 定时器任务:
-        定时器任务[group_id].cancel()
+    if gs.timer is not None:
+        gs.timer.cancel()
         logging.info(f"⏹️ 取消已有定时器 | 群 {group_id}")
 
-    delay = STORE.settings.get("welcome_delay_seconds", 60)
-    task = asyncio.create_task(schedule_welcome(ws, group_id))
-    定时器任务[group_id] = task
+    delay = schedule_welcome(ws, group_id, gs)
     logging.info(f"⏱️ 设定新定时器 | 群 {group_id} | delay={delay}s")
-    await send_group_msg(ws, STORE.settings["log_group"], f"【日志】定时器重置：{group_id}")
+    await send_log(ws, LOG_TIMER_RESET, group_id)
 
-async def schedule_welcome(ws, group_id):
+def schedule_welcome(ws, group_id: str, gs: GroupState) -> float:
+    """
+    welcome_delay_seconds 后开始发送欢迎。等待只挂一个 call_later 的 TimerHandle，
+    不为每次入群单独起一个 sleep 的 Task；返回本次的延迟秒数。
+    """
     delay = STORE.settings.get("welcome_delay_seconds", 60)
-    try:
-        await asyncio.wait_for(asyncio.sleep(delay), timeout=delay + 10)
-    except asyncio.CancelledError:
-        logging.info(f"🛑 定时器被取消 | 群 {group_id}")
-        return
+    gs.timer = asyncio.get_running_loop().call_later(delay, _start_welcome, ws, group_id, gs)
+    return delay
+
+def _start_welcome(ws, group_id: str, gs: GroupState):
+    # 到点才起发送任务；发送期间 timer 指向它，有新人入群时照样能取消
+    gs.timer = asyncio.create_task(send_welcome(ws, group_id))
 
-    新人列表 = 新人记录.get(group_id, [])
+@log_exceptions
+async def send_welcome(ws, group_id):
+    gs = GROUP_STATE.get(group_id)
+    新人列表 = list(gs.newcomers) if gs else []
     if not 新人列表:
         logging.info(f"⚠️ 欢迎触发失败：新人列表为空 | 群 {group_id}")
-        await send_group_msg(ws, STORE.settings["log_group"], f"【日志】触发失败：新人列表为空，群号：{group_id}")
+        await send_log(ws, LOG_WELCOME_EMPTY, group_id)
         return
 
     logging.info(f"🚀 开始发送欢迎消息 | 群 {group_id} | 新人={新人列表}")
-    await send_group_msg(ws, STORE.settings["log_group"], f"【日志】开始发送欢迎消息：{group_id}")
+    await send_log(ws, LOG_WELCOME_START, group_id)
 
     gap = STORE.settings.get("welcome_gap_seconds", 1)
 
     # 1) welcome 根级 md → 普通消息（按文件名顺序）
-    for order_key, body, path in sorted(STORE.welcome_plain, key=lambda x: x[0]):
+    #    gap 只加在“根级文本整体”与各个合并转发之间，根级文本彼此之间不再停顿
+    #    gap > 0 时等到上一条的应答再发下一条，保证顺序；
+    #    不要求间隔时先按顺序把所有帧写出去，再一起等应答（K 次往返 → 约 1 次）
+    futs = []
+    for order_key, body, path in STORE.welcome_plain:
         if body:
             logging.info(f"📝 发送欢迎根级文本 | 群 {group_id} | 文件={path.name}")
-            await send_group_msg(ws, group_id, body)
-            await asyncio.sleep(gap)
+            fut = post_group_msg(ws, group_id, body)
+            if gap > 0:
+                await asyncio.wait_for(fut, timeout=ACTION_TIMEOUT)
+            futs.append(fut)
+    if gap <= 0:
+        await asyncio.gather(*(asyncio.wait_for(f, timeout=ACTION_TIMEOUT) for f in futs))
+    elif futs:
+        await asyncio.sleep(gap)
 
     # 2) welcome 子目录 → 合并转发（按目录名顺序；目录内按文件名顺序）
-    for dir_key, parts, dir_path in sorted(STORE.welcome_packs, key=lambda x: x[0]):
-        texts = [b for _, b, _ in sorted(parts, key=lambda x: x[0]) if b]
-        files = [p.name for _, _, p in sorted(parts, key=lambda x: x[0])]
-        if texts:
-            logging.info(f"📦 发送欢迎合并转发 | 群 {group_id} | 目录={dir_path.name} | 片段={files}")
-            await send_forward_message(ws, group_id, texts, STORE.self_id or STORE.settings.get("forward_sender_id", "2162317375"))
+    for pk in STORE.welcome_packs:
+        if pk.texts:
+            logging.info(f"📦 发送欢迎合并转发 | 群 {group_id} | 目录={pk.dir_path.name} | 片段={pk.files}")
+            await send_forward_message(ws, group_id, pk.texts, STORE.self_id or STORE.settings.get("forward_sender_id", "2162317375"))
             await asyncio.sleep(gap)
 
     # 3) @ 新人
@@ -383,90 +893,77 @@ async def schedule_welcome(ws, group_id):
         await send_group_msg(ws, group_id, at_text)
 
     # 清理
-    新人记录.pop(group_id, None)
-    定时器任务.pop(group_id, None)
+    GROUP_STATE.pop(group_id, None)
     logging.info(f"🧹 清理欢迎状态完成 | 群 {group_id}")
 
 # ==================== 触发许可判断 ====================
 def is_group_trigger_allowed(group_id: str) -> bool:
     """是否允许该群触发（白名单直通；非白名单需全局允许且在已开启列表中）"""
     group_id = str(group_id)
-    trigger_groups = set(str(x) for x in STORE.settings.get("trigger_groups", []))
-    if group_id in trigger_groups:
+    if group_id in STORE.trigger_groups:
         return True
-    if STORE.settings.get("trigger_allow_nonlisted_groups", False):
-        return group_id in set(TRIG_STATE.get("group_enabled", []))
+    if STORE.allow_nonlisted:
+        return group_id in TRIG_STATE["group_enabled"]
     return False
 
 def is_private_trigger_allowed(user_id: str) -> bool:
     """是否允许这个私聊触发：需全局开且不在关闭名单"""
-    if not STORE.settings.get("trigger_enable_private", True):
+    if not STORE.enable_private:
         return False
-    blocked = set(TRIG_STATE.get("dm_blocked", []))
-    return str(user_id) not in blocked
+    return str(user_id) not in TRIG_STATE["dm_blocked"]
 
 # ==================== 触发逻辑 ====================
-def has_reply_segment(event: dict) -> bool:
-    """是否包含 OneBot11 标准 reply 段（仅用于日志，不作为触发入口）"""
-    msg = event.get("message")
-    if not isinstance(msg, list):
+def contains_any_name(text: str, names_re: Optional[re.Pattern]) -> bool:
+    """是否包含称呼中的任意名字（不区分大小写，直接子串匹配；names_re 见 Store.load_all）"""
+    if not text or names_re is None:
         return False
-    return any(seg.get("type") == "reply" for seg in msg)
-
-def collect_other_ats(event: dict, self_id: Optional[str]) -> List[str]:
-    """
-    收集整条消息中 @到的“其他用户”（排除 @all 与 @bot 自己），按出现顺序去重。
+    return names_re.search(text) is not None
+
+@dataclass(slots=True)
+class MessageScan:
+    """scan_message 的结果"""
+    has_at_me: bool = False       # 是否 @ 了机器人（任意位置）
+    src_text: str = ""            # 所有 text 段拼起来（去首尾空白，规避 CQ 码）；没有则退回原始文本
+    has_reply: bool = False       # 是否包含标准 reply 段（仅用于日志，不作为触发入口）
+    other_ats: List[str] = field(default_factory=list)  # @到的“其他用户”，按出现顺序去重
+    name_hit: bool = False        # src_text 里是否提到机器人称呼
+
+def scan_message(event: dict, self_id: Optional[str], names_re: Optional[re.Pattern],
+                 fallback: str = "") -> MessageScan:
     """
-    msg = event.get("message")
-    if not isinstance(msg, list):
-        return []
-    seen = set()
-    order = []
-    for seg in msg:
-        if seg.get("type") != "at":
-            continue
-        qq = str(seg.get("data", {}).get("qq", "")).strip()
-        if not qq or qq.lower() == "all":
-            continue
-        if self_id is not None and qq == str(self_id):
-            continue
-        if qq not in seen:
-            seen.add(qq)
-            order.append(qq)
-    return order
-
-def extract_at_info_and_text(event: dict, self_id: Optional[str]) -> Tuple[bool, str]:
-    """
-    从 OneBot11 消息段中提取：
-    - has_at_me：是否 @ 了机器人（任意位置）
-    - text_all：把所有 text 段拼起来（保持顺序，去除首尾空白）
+    一次遍历 OneBot11 消息段，把触发判断要用的信息都取出来（见 MessageScan）。
+    other_ats 排除 @all 与 @bot 自己；fallback 是没有 text 段时用的原始文本。
     """
-    msg = event.get("message")
-    if not isinstance(msg, list):
-        return False, ""
-
-    has_at_me = any(
-        seg.get("type") == "at" and str(seg.get("data", {}).get("qq")) == str(self_id)
-        for seg in msg
-    )
+    scan = MessageScan()
     texts: List[str] = []
-    for seg in msg:
-        if seg.get("type") == "text":
-            texts.append(str(seg.get("data", {}).get("text", "")))
-    text_all = "".join(texts).strip()
-    return has_at_me, text_all
-
-def contains_any_name(text: str, names: List[str]) -> bool:
-    """是否包含称呼中的任意名字（不区分大小写，直接子串匹配）"""
-    if not text or not names:
-        return False
-    low = text.lower()
-    for nm in names:
-        if nm and nm.lower() in low:
-            return True
-    return False
-
-async def handle_custom_triggers(ws, group_id, user_id, message, event=None):
+    msg = event.get("message")
+    if isinstance(msg, list):
+        me = str(self_id)
+        seen = set()
+        for seg in msg:
+            t = seg.get("type")
+            if t == "text":
+                texts.append(str(seg.get("data", {}).get("text", "")))
+            elif t == "at":
+                data = seg.get("data", {})
+                if str(data.get("qq")) == me:
+                    scan.has_at_me = True
+                qq = str(data.get("qq", "")).strip()
+                if not qq or qq.lower() == "all":
+                    continue
+                if self_id is not None and qq == me:
+                    continue
+                if qq not in seen:
+                    seen.add(qq)
+                    scan.other_ats.append(qq)
+            elif t == "reply":
+                scan.has_reply = True
+    scan.src_text = ("".join(texts).strip() or fallback).strip()
+    scan.name_hit = contains_any_name(scan.src_text, names_re)
+    return scan
+
+async def handle_custom_triggers(ws, group_id, user_id, message, event=None,
+                                 scan: Optional[MessageScan] = None):
     """
     触发条件（放松版）：
       - 同一条消息内，只要出现【机器人称呼中的任一名字】或【@到机器人】，
@@ -475,79 +972,63 @@ async def handle_custom_triggers(ws, group_id, user_id, message, event=None):
     关键词匹配：不区分大小写的“精确子串”匹配（不再剔除 URL/域名；'1.4.6' 能匹配）。
     """
     raw_msg = (message or "").strip()
-    now = time.time()
 
-    # —— 解析消息结构
-    has_at_me, text_only = (False, "")
-    if isinstance(event, dict):
-        has_at_me, text_only = extract_at_info_and_text(event, STORE.self_id)
-    has_reply = bool(event) and has_reply_segment(event)  # 仅日志
+    # —— 解析消息结构（一次遍历）：优先使用 text 段（规避 CQ 码），否则退回 raw；
+    #    经 dispatch_message 进来时已经扫过，直接用
+    if scan is None:
+        scan = scan_message(event if isinstance(event, dict) else {}, STORE.self_id, STORE.names_re, raw_msg)
+    has_at_me, name_mentioned = scan.has_at_me, scan.name_hit
 
-    # 优先使用 text_only（规避 CQ 码），否则退回 raw
-    src_text = (text_only or raw_msg).strip()
-    src_lower = src_text.lower()
-
-    # —— 入口判定：必须满足（@bot 或 提到名字）之一
-    names = STORE.settings.get("names", []) or []
-    name_mentioned = contains_any_name(src_text, names)
+    # —— 入口判定：必须满足（@bot 或 提到名字）之一；绝大多数消息在这里就返回，之后的工作都不做
     if not (has_at_me or name_mentioned):
-        logging.debug(f"🔎 入口未满足：无@bot且未提到称呼 | 群 {group_id} | 用户 {user_id} | msg={raw_msg!r}")
+        logging.debug("🔎 入口未满足：无@bot且未提到称呼 | 群 %s | 用户 %s | msg=%r", group_id, user_id, raw_msg)
         return
 
     # —— 冷却（普通用户）
+    now = time.monotonic()
     key = (group_id, user_id)
     if user_id != STORE.settings.get("super_user_id", ""):
-        last = 触发冷却记录.get(key, 0.0)
+        last = TRIG_COOLDOWN.get(key)
         cd = STORE.settings.get("trigger_cooldown_seconds", 1)
-        if now - last < cd:
-            logging.info(f"⏳ 冷却拦截 | 群 {group_id} | 用户 {user_id} | cd={cd}s | since={now - last:.2f}s")
+        if last is not None and now - last < cd:
+            logging.info("⏳ 冷却拦截 | 群 %s | 用户 %s | cd=%ss | since=%.2fs", group_id, user_id, cd, now - last)
             return
-        触发冷却记录[key] = now
-
-    # —— 关键词匹配：不区分大小写的子串（支持 '1.4.6' 这类含点关键词）
-    def kw_hit(kw: str) -> bool:
-        return bool(kw) and kw.lower() in src_lower
+        record_cooldown(key, now, cd)
 
+    # —— 关键词匹配：不区分大小写的子串（支持 '1.4.6' 这类含点关键词），见 build_keyword_index
+    src_lower = scan.src_text.lower()
     best_single = None
     best_len_s = 0
     best_kw_single = None
-
-    for trg_list, order_key, body, p in STORE.trig_singles:
-        for kw in sorted(trg_list, key=len, reverse=True):
-            if kw_hit(kw) and len(kw) > best_len_s:
-                best_single = (trg_list, order_key, body, p)
-                best_len_s = len(kw)
-                best_kw_single = kw
-                break
+    hit = longest_keyword(STORE.ac_single, src_lower)
+    if hit:
+        best_len_s, best_kw_single, idx = hit
+        best_single = STORE.trig_singles[idx]
 
     best_group = None
     best_len_g = 0
     best_kw_group = None
-
-    for trg_list, dir_key, parts, d in STORE.trig_groups:
-        for kw in sorted(trg_list, key=len, reverse=True):
-            if kw_hit(kw) and len(kw) > best_len_g:
-                best_group = (trg_list, dir_key, parts, d)
-                best_len_g = len(kw)
-                best_kw_group = kw
-                break
+    hit = longest_keyword(STORE.ac_group, src_lower)
+    if hit:
+        best_len_g, best_kw_group, idx = hit
+        best_group = STORE.trig_groups[idx]
 
     logging.info(
-        f"💬 触发候选 | 群 {group_id} | 用户 {user_id} | "
-        f"has_at_me={has_at_me} | name_mentioned={name_mentioned} | has_reply={has_reply} | "
-        f"best_single_kw={best_kw_single!r} | best_group_kw={best_kw_group!r}"
+        "💬 触发候选 | 群 %s | 用户 %s | "
+        "has_at_me=%s | name_mentioned=%s | has_reply=%s | "
+        "best_single_kw=%r | best_group_kw=%r",
+        group_id, user_id, has_at_me, name_mentioned, scan.has_reply, best_kw_single, best_kw_group,
     )
 
     # —— 若完全未命中任何关键词 → 不触发
     if not best_single and not best_group:
-        logging.debug(f"🙈 未命中任何触发词 | 群 {group_id} | 用户 {user_id}")
+        logging.debug("🙈 未命中任何触发词 | 群 %s | 用户 %s", group_id, user_id)
         return
 
     # —— 组合触发优先（若关键字不短于单条）
     if best_group and best_len_g >= best_len_s:
-        texts = [b for _, b, _ in sorted(best_group[2], key=lambda x: x[0]) if b]
-        files = [p.name for _, _, p in sorted(best_group[2], key=lambda x: x[0])]
-        logging.info(f"✅ 组合触发 | 群 {group_id} | 用户 {user_id} | 关键字={best_kw_group!r} | 片段={files}")
+        texts, files = best_group.texts, best_group.files
+        logging.info("✅ 组合触发 | 群 %s | 用户 %s | 关键字=%r | 片段=%s", group_id, user_id, best_kw_group, files)
 
         if texts:
             is_private = bool(event) and (event.get("message_type") == "private")
@@ -568,10 +1049,10 @@ async def handle_custom_triggers(ws, group_id, user_id, message, event=None):
                     ws, group_id, texts,
                     STORE.self_id or STORE.settings.get("forward_sender_id", "2162317375")
                 )
-                logging.info(f"📨 合并转发已发送 | 群 {group_id} | fwd_id={fwd_id}")
+                logging.info("📨 合并转发已发送 | 群 %s | fwd_id=%s", group_id, fwd_id)
 
-                # 收集本条消息中 @到的其他用户（全量）
-                order_qqs = collect_other_ats(event or {}, STORE.self_id)
+                # 本条消息中 @到的其他用户（全量，scan_message 已收集）
+                order_qqs = scan.other_ats
 
                 delay_after_forward = float(STORE.settings.get("group_forward_then_at_delay_seconds", 1.0))
                 try:
@@ -586,39 +1067,39 @@ async def handle_custom_triggers(ws, group_id, user_id, message, event=None):
                 for q in order_qqs:
                     segs.append({"type": "at", "data": {"qq": q}})
                 await send_group_msg_segments(ws, group_id, segs)
-                logging.info(f"📣 已 reply+@ | 群 {group_id} | at={order_qqs} | reply_to={fwd_id}")
+                logging.info("📣 已 reply+@ | 群 %s | at=%s | reply_to=%s", group_id, order_qqs, fwd_id)
         return
 
     # —— 单条触发
     if best_single:
-        logging.info(f"✅ 单条触发 | 群 {group_id} | 用户 {user_id} | 关键字={best_kw_single!r} | 文件={best_single[3].name}")
+        logging.info("✅ 单条触发 | 群 %s | 用户 %s | 关键字=%r | 文件=%s", group_id, user_id, best_kw_single, best_single[3].name)
         is_private = bool(event) and (event.get("message_type") == "private")
         if is_private:
             await send_private_msg(ws, user_id, best_single[2])
         else:
             await send_group_msg(ws, group_id, best_single[2])
-        logging.info(f"📨 单条消息已发送 | 目标={'私聊' if is_private else group_id}")
+        logging.info("📨 单条消息已发送 | 目标=%s", "私聊" if is_private else group_id)
         return
 
 # ==================== 开关命令：名字 + 回应(开|关) ====================
-def _build_switch_regex() -> Optional[re.Pattern]:
+def _build_switch_regex(names: List[str]) -> Optional[re.Pattern]:
     """
     形如：
       洛拉娜请回应开
       洛拉娜回应 关
     """
-    names = STORE.settings.get("names", []) or []
     if not names:
         return None
-    name_alt = "|".join(re.escape(n) for n in names if n)
+    name_alt = "|".join(re.escape(n) for n in names)
     # ^\s* 允许整条消息前有空白；\s*$ 允许末尾空白
     # 名字 与 “回应” 之间不允许空格；“回应”和“开/关”之间允许空白
     pat = rf"(?i)^\s*(?:{name_alt})回应\s*([开关])\s*$"
     return re.compile(pat)
 
-async def maybe_handle_trigger_switch(ws, event: dict) -> bool:
+async def maybe_handle_trigger_switch(ws, event: dict, text: str) -> bool:
     """
     处理开关命令。命中则返回 True（表示已处理，不再继续触发匹配）。
+    text 是 scan_message 拼好的 text 段（没有则是 raw_message），由 dispatch_message 传入。
     约束：
       - 群内需群主/管理员/超管才能操作；
       - 配置白名单群（trigger_groups）禁止被“回应关”；
@@ -628,23 +1109,17 @@ async def maybe_handle_trigger_switch(ws, event: dict) -> bool:
     if not isinstance(event, dict) or event.get("post_type") != "message":
         return False
 
-    msg_type = event.get("message_type")
-    user_id = str(event.get("user_id"))
-    group_id = str(event.get("group_id")) if msg_type == "group" else None
-
-    # 拼 text_only（仅 text 段）
-    _, text_only = extract_at_info_and_text(event, STORE.self_id)
-    text = (text_only or event.get("raw_message") or "").strip()
-    if not text:
-        return False
-
-    rx = _build_switch_regex()
-    if not rx:
+    rx = STORE.switch_re
+    if not text or not rx:
         return False
     m = rx.fullmatch(text)
     if not m:
         return False
 
+    msg_type = event.get("message_type")
+    user_id = _sid(event.get("user_id"))
+    group_id = _sid(event.get("group_id")) if msg_type == "group" else None
+
     action = m.group(1)
     super_id = str(STORE.settings.get("super_user_id", ""))
 
@@ -652,12 +1127,12 @@ async def maybe_handle_trigger_switch(ws, event: dict) -> bool:
     if msg_type == "private":
         if action == "关":
             if user_id not in TRIG_STATE["dm_blocked"]:
-                TRIG_STATE["dm_blocked"].append(user_id)
+                TRIG_STATE["dm_blocked"].add(user_id)
                 _state_save()
             await send_private_msg(ws, user_id, "已为该私聊关闭触发（回复“名字回应开”可重新开启）。")
         else:  # 开
             if user_id in TRIG_STATE["dm_blocked"]:
-                TRIG_STATE["dm_blocked"].remove(user_id)
+                TRIG_STATE["dm_blocked"].discard(user_id)
                 _state_save()
             await send_private_msg(ws, user_id, "已为该私聊开启触发。")
         return True
@@ -670,7 +1145,7 @@ async def maybe_handle_trigger_switch(ws, event: dict) -> bool:
             await send_group_msg(ws, group_id, "只有群主/管理员或超管可以使用该命令。")
             return True
 
-        trigger_groups = set(str(x) for x in STORE.settings.get("trigger_groups", []))
+        trigger_groups = STORE.trigger_groups
 
         if action == "关":
             # 白名单群禁止被关
@@ -679,34 +1154,168 @@ async def maybe_handle_trigger_switch(ws, event: dict) -> bool:
                 return True
             # 非白名单：从“已开启列表”移除
             if group_id in TRIG_STATE["group_enabled"]:
-                TRIG_STATE["group_enabled"].remove(group_id)
+                TRIG_STATE["group_enabled"].discard(group_id)
                 _state_save()
             await send_group_msg(ws, group_id, "已关闭本群的触发。")
             return True
         else:  # 开
             # 全局必须允许非白名单群可开
-            if (group_id not in trigger_groups) and (not STORE.settings.get("trigger_allow_nonlisted_groups", False)):
+            if (group_id not in trigger_groups) and (not STORE.allow_nonlisted):
                 await send_group_msg(ws, group_id, "当前未启用“非白名单群可触发”，请先在配置中开启。")
                 return True
             # 白名单群自然已开；非白名单则加入“已开启列表”
             if (group_id not in trigger_groups) and (group_id not in TRIG_STATE["group_enabled"]):
-                TRIG_STATE["group_enabled"].append(group_id)
+                TRIG_STATE["group_enabled"].add(group_id)
                 _state_save()
             await send_group_msg(ws, group_id, "已开启本群的触发。")
             return True
 
     return False
 
+# ==================== 事件分发 ====================
+async def dispatch_message(ws, group_id: str, user_id: str, raw: str, event: dict, allowed: bool):
+    """
+    群聊/私聊消息共用：消息段只扫一遍，先处理开关命令（命中即返回），
+    不是命令且允许触发时再拿同一份扫描结果做触发匹配。私聊时 group_id 就是对方 QQ。
+    """
+    scan = scan_message(event, STORE.self_id, STORE.names_re, (raw or "").strip())
+    if await maybe_handle_trigger_switch(ws, event, scan.src_text):
+        return
+    if allowed:
+        await handle_custom_triggers(ws, group_id, user_id, raw, event, scan)
+    else:
+        logging.debug("⛔ 触发未启用或未被允许 | 群/私聊 %s", group_id)
+
+@dataclass(slots=True)
+class RunConfig:
+    """main() 启动时读定的开关（和以前一样，不随热重载变化）"""
+    welcome_enabled: bool
+    welcome_groups: Set[str]
+    log_group: str
+    trigger_enabled: bool
+
+@log_exceptions
+async def on_group_increase(ws, event: dict, cfg: RunConfig):
+    """新成员入群"""
+    group_id = _sid(event["group_id"])
+    user_id = _sid(event["user_id"])
+    logging.info(f"📥 收到入群事件 | 群 {group_id} | 用户 {user_id}")
+    if cfg.welcome_enabled and group_id in cfg.welcome_groups:
+        await handle_new_member(ws, group_id, user_id)
+    else:
+        logging.info(f"⛔ 欢迎未启用或不在白名单群 | 群 {group_id}")
+
+@log_exceptions
+async def on_group_message(ws, event: dict, cfg: RunConfig):
+    """群消息"""
+    group_id = _sid(event["group_id"])
+    user_id = _sid(event["user_id"])
+    raw = event.get("raw_message", "")
+    logging.debug("✉️ 群消息 | 群 %s | 用户 %s | 内容=%r", group_id, user_id, raw)
+
+    # 手动触发迎新
+    if (
+        cfg.welcome_enabled and group_id in cfg.welcome_groups
+        and user_id == STORE.settings.get("super_user_id", "")
+        and raw.strip() == STORE.settings.get("test_command", "Another Me，测试迎新")
+    ):
+        logging.info(f"🧪 收到测试迎新指令 | 群 {group_id} | 触发者 {user_id}")
+        await send_group_msg(ws, cfg.log_group, f"【日志】收到测试迎新指令，立即执行：{group_id}")
+        gs = group_state(group_id)
+        gs.newcomers = {user_id: None}
+        if gs.timer is not None:
+            gs.timer.cancel()
+            logging.info(f"⏹️ 测试迎新：清理旧定时器 | 群 {group_id}")
+        schedule_welcome(ws, group_id, gs)
+        return
+
+    allowed = cfg.trigger_enabled and is_group_trigger_allowed(group_id)
+    await dispatch_message(ws, group_id, user_id, raw, event, allowed)
+
+@log_exceptions
+async def on_private_message(ws, event: dict, cfg: RunConfig):
+    """私聊消息"""
+    user_id = _sid(event["user_id"])
+    raw = event.get("raw_message", "")
+    logging.debug("✉️ 私聊 | 用户 %s | 内容=%r", user_id, raw)
+
+    allowed = cfg.trigger_enabled and is_private_trigger_allowed(user_id)
+    await dispatch_message(ws, user_id, user_id, raw, event, allowed)
+
+# post_type 之下按 message_type / notice_type 查表分发；表里没有的事件直接忽略
+MESSAGE_HANDLERS = {
+    "group": on_group_message,
+    "private": on_private_message,
+}
+NOTICE_HANDLERS = {
+    "group_increase": on_group_increase,
+}
+
+# 分发 worker：事件按群号（私聊按 QQ）分片，不同群并发处理（一个群在等应答时不挡别的群），
+# 同一群/同一私聊仍落在同一个 worker 上，按到达顺序串行
+DISPATCH_WORKERS = 8
+# 每个分片最多积压的事件数。分片满时主循环只让出一轮事件循环（处理得快的 worker 借此清空队列），
+# 仍然满就丢弃并告警：宁可丢掉卡住的群里排不上的事件，也不让它拖住别的群、把积压推回 EVENT_QUEUE 无限增长
+SHARD_QUEUE_MAX = 256
+
+# 当前连接的动作通道，断线期间为 None / WS_READY 未置位。
+# worker 取出事件时才去拿它：断线前排进分片的事件等重连后在新连接上处理，不会绑死在已关闭的旧通道上
+ACTIVE_WS: Optional[WSChannel] = None
+WS_READY = asyncio.Event()
+
+async def dispatch_worker(q: "Queue[tuple]", cfg: RunConfig):
+    while True:
+        handler, event = await q.get()
+        await WS_READY.wait()
+        try:
+            await handler(ACTIVE_WS, event, cfg)  # 普通异常 handler 自己用 log_exceptions 记掉
+        except asyncio.CancelledError:
+            # 断线时 WSChannel.close() 会取消还在等的应答；只有 worker 自己被取消才退出
+            if asyncio.current_task().cancelling():
+                raise
+            logging.warning("事件处理中断：连接已断开")
+
+def shard_of(event: dict) -> int:
+    return hash(event.get("group_id") or event.get("user_id")) % DISPATCH_WORKERS
+
 # ==================== 主循环 ====================
+# 断线重连的退避（秒）：每失败一次翻倍，封顶 RECONNECT_MAX；连接建立成功就回到 RECONNECT_MIN
+RECONNECT_MIN = 1.0
+RECONNECT_MAX = 30.0
+
+def _wake_on_reader_exit(task: asyncio.Task):
+    """收包任务结束（连接断开）时往 EVENT_QUEUE 放一个 None，叫醒主循环去重连；主动取消的不算"""
+    if not task.cancelled():
+        EVENT_QUEUE.put_nowait(None)
+
+async def reconnect_sleep(backoff: float) -> float:
+    """按当前退避时长加 ±50% 抖动等待，返回下一次的退避时长"""
+    delay = backoff * (0.5 + random.random())
+    logging.info(f"⏳ {delay:.1f} 秒后重连")
+    await asyncio.sleep(delay)
+    return min(backoff * 2, RECONNECT_MAX)
+
 async def reloader_loop():
+    watching = STORE.start_watch()
+    if watching:
+        logging.info(f"👀 已通过 watchdog 监听配置目录：{CONF}")
+    else:
+        logging.info("👀 未安装 watchdog，退回每 2 秒轮询配置文件")
     while True:
+        if watching:
+            await STORE.wait_dirty()
         try:
-            STORE.maybe_reload()
+            if watching:
+                STORE.reload()
+            else:
+                STORE.maybe_reload()
         except Exception as e:
             logging.warning(f"热重载异常：{e}")
-        await asyncio.sleep(2)
+        if not watching:
+            await asyncio.sleep(2)
 
 async def main():
+    global ACTIVE_WS
     logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(message)s')
     STORE.load_all()
     _state_load()
@@ -716,6 +1325,7 @@ async def main():
     welcome_groups = set(str(x) for x in STORE.settings.get("welcome_groups", []))
     log_group = STORE.settings.get("log_group", "")
     trigger_enabled = STORE.settings.get("trigger_enabled", True)
+    cfg = RunConfig(welcome_enabled, welcome_groups, log_group, trigger_enabled)
 
     if "trigger_groups" in STORE.settings:
         trigger_groups = set(str(x) for x in STORE.settings.get("trigger_groups", []))
@@ -725,21 +1335,40 @@ async def main():
 
     logging.info(f"🎯 触发启用：{trigger_enabled} | 触发群：{sorted(list(trigger_groups))}")
     logging.info(f"🔌 WebSocket 地址：{uri}")
+    logging.info(f"🌀 事件循环：{type(asyncio.get_running_loop()).__module__}")
     logging.info(f"👮‍♀️ 欢迎启用：{welcome_enabled} | 欢迎群：{sorted(list(welcome_groups))}")
 
-    # 启动热重载
+    # 启动热重载、触发状态写盘、分发 worker
     asyncio.create_task(reloader_loop())
+    asyncio.create_task(state_writer_loop())
+    shards = [Queue(SHARD_QUEUE_MAX) for _ in range(DISPATCH_WORKERS)]
+    for q in shards:
+        asyncio.create_task(dispatch_worker(q, cfg))
 
-    while True:
-        try:
-            async with websockets.connect(uri) as ws:
-                logging.info("✅ WebSocket 连接成功，监听中…")
-                # 启动收包任务
-                reader_task = asyncio.create_task(ws_reader(ws))
-                try:
-                    while True:
-                        event = await EVENT_QUEUE.get()
-                        try:
+    backoff = RECONNECT_MIN
+    try:
+        while True:
+            try:
+                async with websockets.connect(uri) as conn:
+                    logging.info("✅ WebSocket 连接成功，监听中…")
+                    # 心跳等 meta_event 在 reader 里就被丢掉了，不能靠“收到事件”来重置，
+                    # 否则安静的连接下次断开时还按上次累积的退避等待
+                    backoff = RECONNECT_MIN
+                    ws = WSChannel(conn)
+                    ACTIVE_WS = ws
+                    WS_READY.set()
+                    # 启动收包任务；它结束（连接断开）时见 _wake_on_reader_exit
+                    reader_task = asyncio.create_task(ws.reader())
+                    reader_task.add_done_callback(_wake_on_reader_exit)
+                    try:
+                        while True:
+                            event = await EVENT_QUEUE.get()
+                            if event is None:
+                                if not reader_task.done():
+                                    continue  # 上一条连接留下的
+                                reader_task.result()  # 异常断开：把异常抛出去走下面的重连分支
+                                logging.warning("🔌 连接已被对端关闭，尝试重连")
+                                break
                             # 记录 self_id（仅首次）
                             if STORE.self_id is None:
                                 sid = event.get("self_id")
@@ -747,75 +1376,40 @@ async def main():
                                     STORE.self_id = str(sid)
                                     logging.info(f"🤖 当前机器人 ID：{STORE.self_id}")
 
-                            # 新成员入群
-                            if event.get("post_type") == "notice" and event.get("notice_type") == "group_increase":
-                                group_id = str(event["group_id"])
-                                user_id = str(event["user_id"])
-                                logging.info(f"📥 收到入群事件 | 群 {group_id} | 用户 {user_id}")
-                                if welcome_enabled and group_id in welcome_groups:
-                                    await handle_new_member(ws, group_id, user_id)
-                                else:
-                                    logging.info(f"⛔ 欢迎未启用或不在白名单群 | 群 {group_id}")
-
-                            # 群消息
-                            elif event.get("post_type") == "message" and event.get("message_type") == "group":
-                                group_id = str(event["group_id"])
-                                user_id = str(event["user_id"])
-                                raw = event.get("raw_message", "")
-                                logging.debug(f"✉️ 群消息 | 群 {group_id} | 用户 {user_id} | 内容={raw!r}")
-
-                                # 手动触发迎新
-                                if (
-                                    welcome_enabled and group_id in welcome_groups
-                                    and user_id == STORE.settings.get("super_user_id", "")
-                                    and raw.strip() == STORE.settings.get("test_command", "Another Me，测试迎新")
-                                ):
-                                    logging.info(f"🧪 收到测试迎新指令 | 群 {group_id} | 触发者 {user_id}")
-                                    await send_group_msg(ws, log_group, f"【日志】收到测试迎新指令，立即执行：{group_id}")
-                                    新人记录[group_id] = [user_id]
-                                    if group_id in 定时器任务:
-                                        定时器任务[group_id].cancel()
-                                        定时器任务.pop(group_id, None)
-                                        logging.info(f"⏹️ 测试迎新：清理旧定时器 | 群 {group_id}")
-                                    await schedule_welcome(ws, group_id)
-                                else:
-                                    # 先处理开关命令（命中即返回）
-                                    if await maybe_handle_trigger_switch(ws, event):
-                                        continue
-
-                                    if trigger_enabled and is_group_trigger_allowed(group_id):
-                                        await handle_custom_triggers(ws, group_id, user_id, raw, event)
-                                    else:
-                                        logging.debug(f"⛔ 触发未启用或该群未被允许 | 群 {group_id}")
-                            # 私聊消息
-                            elif event.get("post_type") == "message" and event.get("message_type") == "private":
-                                user_id = str(event["user_id"])
-                                raw = event.get("raw_message", "")
-                                logging.debug(f"✉️ 私聊 | 用户 {user_id} | 内容={raw!r}")
-
-                                # 先尝试处理开关命令（命中即返回）
-                                if await maybe_handle_trigger_switch(ws, event):
-                                    continue
-
-                                # 允许触发再匹配
-                                if trigger_enabled and is_private_trigger_allowed(user_id):
-                                    await handle_custom_triggers(ws, group_id=user_id, user_id=user_id, message=raw, event=event)
-                                else:
-                                    logging.debug(f"⛔ 私聊触发未启用或该私聊已关闭 | QQ {user_id}")
-
-                        except Exception as e:
-                            logging.warning(f"事件处理异常：{e}")
-                finally:
-                    reader_task.cancel()
-        except websockets.exceptions.ConnectionClosedError as e:
-            logging.warning(f"🔌 连接关闭，尝试重连：{e}")
-            await asyncio.sleep(5)
-        except Exception as e:
-            logging.warning(f"🔌 连接异常，5秒后重试：{e}")
-            await asyncio.sleep(5)
+                            post_type = event.get("post_type")
+                            if post_type == "message":
+                                handler = MESSAGE_HANDLERS.get(event.get("message_type"))
+                            elif post_type == "notice":
+                                handler = NOTICE_HANDLERS.get(event.get("notice_type"))
+                            else:
+                                continue
+                            if handler is not None:
+                                q = shards[shard_of(event)]
+                                if q.full():
+                                    await asyncio.sleep(0)
+                                try:
+                                    q.put_nowait((handler, event))
+                                except QueueFull:
+                                    logging.warning(
+                                        "分发队列已满，丢弃事件 | 群 %s | 用户 %s",
+                                        event.get("group_id"), event.get("user_id"),
+                                    )
+                    finally:
+                        WS_READY.clear()
+                        ACTIVE_WS = None
+                        reader_task.cancel()
+                        ws.close()
+            except websockets.exceptions.ConnectionClosedError as e:
+                logging.warning(f"🔌 连接关闭，尝试重连：{e}")
+            except Exception as e:
+                logging.warning(f"🔌 连接异常，稍后重试：{e}")
+            backoff = await reconnect_sleep(backoff)
+    finally:
+        cancel_all_timers()
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop if uvloop else None) as runner:
+            runner.run(main())
     except KeyboardInterrupt:
         logging.info("退出程序")